@@ -0,0 +1,56 @@
+#!python3
+
+import ast
+import hashlib
+import os
+import pathlib
+import pickle
+import sys
+import tempfile
+
+CACHE_DIR = pathlib.Path.home() / ".cache" / "compilers-ast"
+
+
+def cached_parse(filename: str) -> ast.AST:
+  """
+  Parse a python source file, reusing a previously pickled AST if the
+  file contents haven't changed
+
+  :param filename: path to file to parse
+  :return: ast tree for file
+  """
+  with open(filename, "rb") as source:
+    source_bytes = source.read()
+  # ASTs differ between python versions so include the version in the key
+  digest = hashlib.sha256(source_bytes).hexdigest()
+  version = "".join(str(x) for x in sys.version_info[:2])
+  cache_path = CACHE_DIR / f"{digest}_{version}.pkl"
+  try:
+    return pickle.loads(cache_path.read_bytes())
+  except FileNotFoundError:
+    pass
+  except Exception:
+    # unreadable or corrupt cache entry, drop it and reparse. A damaged
+    # pickle can fail in many ways, not just with UnpicklingError
+    try:
+      cache_path.unlink()
+    except OSError:
+      pass
+
+  tree = ast.parse(source_bytes, filename=filename)
+  try:
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so an interrupted run can't leave a
+    # truncated entry behind
+    fd, tmp_name = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(pickle.dumps(tree))
+      os.replace(tmp_name, cache_path)
+    except BaseException:
+      os.unlink(tmp_name)
+      raise
+  except OSError:
+    # caching is only an optimization, so carry on without it
+    pass
+  return tree
@@ -2,46 +2,135 @@
 
 import argparse
 import ast
-import collections
 import copy
 import sys
 import timeit
 
 import astpretty
 
+import ast_cache
+
+# expression statements allowed in a function that can be inlined, other
+# than a leading docstring
+INLINEABLE_EXPR_TYPES = (ast.Call,)
+
 
 def time_tree(tree: ast.AST):
   """
   Time ast execution
 
+  The tree is compiled once up front so that the timing reflects running
+  the (transformed) code rather than the cost of the bytecode compiler
+
   :param tree: AST tree
   :return: float recording number of seconds to run snippet
   """
-  return timeit.timeit(stmt="exec(compile(tree, 'test', mode='exec'))", number=10000, globals={'tree': tree})
+  code = compile(tree, 'test', mode='exec')
+  return timeit.timeit(stmt="exec(code, {})", number=10000, globals={'code': code})
+
+
+def fix_dirty_locations(dirty: list) -> None:
+  """
+  Add line numbers and column offsets to nodes created by a transformer,
+  only walking those subtrees instead of the whole tree
+
+  :param dirty: list of (new node, node it replaced) tuples
+  :return: None
+  """
+  for new_node, old_node in dirty:
+    if getattr(new_node, 'lineno', None) is None:
+      ast.copy_location(new_node, old_node)
+    ast.fix_missing_locations(new_node)
+
+
+def fold_if(node: ast.If):
+  """
+  Replace an if statement that tests a constant with the branch that is taken
+
+  :param node: ast.If to fold
+  :return: list of statements in the branch taken, None if it is empty or
+           node if the test isn't a constant
+  """
+  if not isinstance(node.test, ast.Constant):
+    return node
+  if node.test.value:
+    new_node = node.body
+  else:
+    new_node = node.orelse
+
+  if not new_node:
+    # if branch being used is empty, delete
+    return None
+  return new_node
+
+
+def fold_boolop(node: ast.BoolOp):
+  """
+  Remove constants at the start of an and/or expression, e.g.
+  True and x gets turned into x and False and x into False
+
+  Only leading constants are folded since values after a non-constant
+  are only evaluated depending on its result
+
+  :param node: ast.BoolOp to fold
+  :return: folded node
+  """
+  # and stops at the first falsy value, or at the first truthy value
+  short_circuit = isinstance(node.op, ast.Or)
+  values = node.values
+  while len(values) > 1 and isinstance(values[0], ast.Constant):
+    if bool(values[0].value) == short_circuit:
+      return values[0]
+    values = values[1:]
+  if len(values) == 1:
+    return values[0]
+  node.values = values
+  return node
+
+
+def fold_unaryop(node: ast.UnaryOp):
+  """
+  Fold not applied to a constant, e.g. not False gets turned into True
+
+  :param node: ast.UnaryOp to fold
+  :return: folded node
+  """
+  if isinstance(node.op, ast.Not) and isinstance(node.operand, ast.Constant):
+    return ast.copy_location(ast.Constant(value=not node.operand.value), node)
+  return node
+
+
+# functions used by RemoveDeadCode to fold each node type
+FOLDERS = {ast.If: fold_if,
+           ast.BoolOp: fold_boolop,
+           ast.UnaryOp: fold_unaryop}
 
 
 class RemoveDeadCode(ast.NodeTransformer):
   """
   Simplify branches that test constants to remove dead code
   e.g. if true: a = 5 else a = 10  gets turned into a = 5
+
+  Boolean expressions on constants are folded as well so that tests like
+  if not False: or if True and x: can be simplified
   """
 
-  def visit_If(self, node):
-    # make sure to recurse on branches
-    super().generic_visit(node)
+  def __init__(self):
+    # nodes replaced by folding, so that only they need locations fixed
+    self.dirty = []
+    super().__init__()
 
-    if type(node.test) in [ast.Constant, ast.NameConstant]:
-      if node.test.value:
-        new_node = node.body
-      else:
-        new_node = node.orelse
+  def generic_visit(self, node: ast.AST):
+    # make sure to recurse first so that children are already folded
+    super().generic_visit(node)
 
-      if not new_node:
-        # if branch being used is empty, delete
-        return None
-      return new_node
-    else:
+    folder = FOLDERS.get(type(node))
+    if folder is None:
       return node
+    new_node = folder(node)
+    if new_node is not node and isinstance(new_node, ast.AST):
+      self.dirty.append((new_node, node))
+    return new_node
 
   def optimize(self, node: ast.AST):
     """
@@ -50,8 +139,15 @@ class RemoveDeadCode(ast.NodeTransformer):
     :param node: node to optimize
     :return: ast tree
     """
+    if isinstance(node, ast.Module) and hasattr(ast, "PyCF_OPTIMIZED_AST"):
+      # python 3.13+ can run CPython's own AST optimizer on a tree, which
+      # folds constant expressions (e.g. not False, 1 + 2) so that more
+      # branch tests are constants by the time they are folded, using the
+      # interpreter's optimization level so __debug__ keeps its meaning
+      node = compile(node, "<ast>", "exec", flags=ast.PyCF_OPTIMIZED_AST, optimize=-1)
     new_node = self.visit(node)
-    ast.fix_missing_locations(new_node)
+    fix_dirty_locations(self.dirty)
+    self.dirty = []
     return new_node
 
 
@@ -64,8 +160,8 @@ class CallOnlyChecker(ast.NodeVisitor):
   """
 
   def __init__(self):
-    self.__function_cache__ = collections.defaultdict(lambda: {'args': [], 'body': []})
-    self.__inlineable_cache__ = collections.defaultdict(lambda: False)
+    self.__function_cache__ = {}
+    self.__inlineable_cache__ = {}
     super().__init__()
 
   def can_inline(self, name: str) -> bool:
@@ -75,16 +171,17 @@ class CallOnlyChecker(ast.NodeVisitor):
     :param name: name of function to check
     :return: True if function can be inlined, False otherwise
     """
-    return self.__inlineable_cache__[name]
+    return self.__inlineable_cache__.get(name, False)
 
   def get_cached_function(self, name: str) -> dict:
     """
-    Get dictionary with function information
+    Get dictionary with function information, the returned dictionary
+    is shared with the cache and should not be modified
 
     :param name: name of function
     :return: a
     """
-    return copy.copy(self.__function_cache__[name])
+    return self.__function_cache__.get(name, {'args': [], 'body': []})
 
   def visit_FunctionDef(self, node: ast.FunctionDef):
     """
@@ -92,30 +189,120 @@ class CallOnlyChecker(ast.NodeVisitor):
     :param node: ast.FunctionDef to analyze
     :return: None
     """
+    docstring = node.body[0]
+    if isinstance(docstring, ast.Expr) and isinstance(docstring.value, ast.Constant) and \
+       isinstance(docstring.value.value, str):
+      # skip docstring
+       call_list = node.body[1:]
+    else:
+      docstring = None
+      call_list = node.body
     for func_node in ast.iter_child_nodes(node):
-      if isinstance(func_node, ast.Expr) and type(func_node.value) in [ast.Str, ast.Call]:
+      if func_node is docstring:
+        next
+      elif isinstance(func_node, ast.Expr) and isinstance(func_node.value, INLINEABLE_EXPR_TYPES):
         next
       elif isinstance(func_node, ast.arguments):
         next
       else:
         self.__inlineable_cache__[node.name] = False
         return
+    if not call_list:
+      # nothing to replace the call with, e.g. a docstring only function
+      self.__inlineable_cache__[node.name] = False
+      return
     self.__inlineable_cache__[node.name] = True
     self.__function_cache__[node.name] = {'args': node.args}
-    if isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Str):
-      # skip docstring
-       call_list = node.body[1:]
-    else:
-      call_list = node.body
-    call_list = map(lambda x: x.value, call_list)
+    call_list = [x.value for x in call_list]
     self.__function_cache__[node.name]['body'] = call_list
 
 
-class InlineFunctions(ast.NodeTransformer):
-  """Inline functions that only have calls in them"""
+class DeadCodeAndInlinePrep(RemoveDeadCode):
+  """
+  Remove dead code and check/cache function definitions for inlining in a
+  single pass over the tree, so InlineFunctions doesn't need to walk the
+  tree again with a CallOnlyChecker
+  """
 
   def __init__(self):
     self.checker = CallOnlyChecker()
+    self.in_function = False
+    # function definitions seen, in source order, and those that
+    # were in a branch removed by folding
+    self.functions = []
+    self.dead_functions = set()
+    super().__init__()
+
+  def generic_visit(self, node: ast.AST):
+    new_node = super().generic_visit(node)
+    if isinstance(node, ast.If) and new_node is not node:
+      # fold_if kept at most one branch, functions in the other are dead
+      dropped = node.orelse if node.test.value else node.body
+      for stmt in dropped:
+        for child in ast.walk(stmt):
+          if isinstance(child, ast.FunctionDef):
+            self.dead_functions.add(child)
+    return new_node
+
+  def visit_FunctionDef(self, node: ast.FunctionDef):
+    """
+    Remove dead code from a function and record it so it can be checked
+    once folding is finished
+    :param node: ast.FunctionDef to analyze
+    :return: pruned node
+    """
+    in_function = self.in_function
+    self.in_function = True
+    super().generic_visit(node)
+    self.in_function = in_function
+    # CallOnlyChecker doesn't look at nested functions so skip them here too
+    if not in_function:
+      self.functions.append(node)
+    return node
+
+  def optimize(self, node: ast.AST):
+    """
+    Optimize nodes and cache the functions that are left for inlining
+
+    :param node: node to optimize
+    :return: ast tree
+    """
+    new_node = super().optimize(node)
+    # only check functions that survived folding, in source order so that a
+    # later definition replaces an earlier one like it does at runtime
+    for function in self.functions:
+      if function not in self.dead_functions:
+        self.checker.visit_FunctionDef(function)
+    self.functions = []
+    self.dead_functions = set()
+    return new_node
+
+
+class SubstituteNames(ast.NodeTransformer):
+  """
+  Replace names in an AST with the nodes given in a replacement table,
+  e.g. to substitute call arguments for function parameters
+  """
+
+  def __init__(self, replacement_table: dict):
+    self.replacement_table = replacement_table
+    super().__init__()
+
+  def visit_Name(self, node: ast.Name):
+    return self.replacement_table.get(node.id, node)
+
+
+class InlineFunctions(ast.NodeTransformer):
+  """Inline functions that only have calls in them"""
+
+  def __init__(self, checker: CallOnlyChecker = None):
+    """
+    :param checker: CallOnlyChecker that has already visited the tree, e.g.
+                    from DeadCodeAndInlinePrep, if None the tree is checked
+                    in optimize
+    """
+    self.prepared = checker is not None
+    self.checker = checker if self.prepared else CallOnlyChecker()
     super().__init__()
 
   def optimize(self, tree: ast.AST):
@@ -126,10 +313,12 @@ class InlineFunctions(ast.NodeTransformer):
     """
 
     # get information about ast
-    self.checker.visit(tree)
+    if not self.prepared:
+      self.checker.visit(tree)
     inlined_tree = self.visit(tree)
+    # inlined calls are copies that already have locations, cleanup fixes
+    # the locations of any Expr nodes it needs to add
     inlined_tree = CleanupAST().cleanup(inlined_tree)
-    ast.fix_missing_locations(inlined_tree)
     return inlined_tree
 
   def visit_Call(self, node):
@@ -137,28 +326,18 @@ class InlineFunctions(ast.NodeTransformer):
     Look at function calls and replace if possible
     """
     super().generic_visit(node)
+    if not isinstance(node.func, ast.Name):
+      # method calls, calls of calls etc. can't be inlined
+      return node
     if self.checker.can_inline(node.func.id):
       replacement_code = self.checker.get_cached_function(node.func.id)
       replacement_args = replacement_code['args']
-      replacement_nodes = []
-      replacement_table = {}
-      index = 0
-      for arg in node.args:
-        arg_name = replacement_args.args[index].arg
-        replacement_table[arg_name] = arg
-        index += 1
-      for call in replacement_code['body']:
-        new_args = []
-        for arg in call.args:
-          if isinstance(arg, ast.Name):
-            if arg.id in replacement_table:
-              new_args.append(replacement_table[arg.id])
-            else:
-              new_args.append(arg)
-          else:
-            new_args.append(arg)
-        call.args = new_args
-        replacement_nodes.append(call)
+      replacement_table = {param.arg: arg for param, arg in zip(replacement_args.args, node.args)}
+      substitute = SubstituteNames(replacement_table).visit
+      deepcopy = copy.deepcopy
+      # work on a copy rather than modifying the cached call so that
+      # the function can be inlined more than once
+      replacement_nodes = [substitute(deepcopy(call)) for call in replacement_code['body']]
       if len(replacement_nodes) == 1:
         return replacement_nodes[0]
       else:
@@ -176,6 +355,11 @@ class CleanupAST(ast.NodeTransformer):
   expressions
   """
 
+  def __init__(self):
+    # Expr nodes added by cleanBody, so that only they need locations fixed
+    self.dirty = []
+    super().__init__()
+
   def cleanBody(self, node_body: list) -> list:
     """
     Clean up expr nodes in a list, splitting expr with
@@ -184,16 +368,19 @@ class CleanupAST(ast.NodeTransformer):
     :param node_body: list of ast nodes
     :return: list of cleaned ast nodes
     """
+    # bind lookups to locals since this runs on every statement list
+    Expr = ast.Expr
     new_body = []
+    append = new_body.append
+    dirty = self.dirty
     for child_node in node_body:
-      if isinstance(child_node, ast.Expr) and isinstance(child_node.value, list):
-          if len(child_node.value) == 1:
-            new_body.append(ast.Expr(value=child_node.value[0]))
-          else:
-            for stmt in child_node.value:
-              new_body.append(ast.Expr(value=child_node.value[0]))
+      if isinstance(child_node, Expr) and isinstance(child_node.value, list):
+        for stmt in child_node.value:
+          new_expr = Expr(value=stmt)
+          dirty.append((new_expr, child_node))
+          append(new_expr)
       else:
-        new_body.append(child_node)
+        append(child_node)
     return new_body
 
   def visit_Module(self, node: ast.Module):
@@ -298,7 +485,8 @@ class CleanupAST(ast.NodeTransformer):
     :return: cleaned AST
     """
     new_tree = self.visit(tree)
-    ast.fix_missing_locations(new_tree)
+    fix_dirty_locations(self.dirty)
+    self.dirty = []
     return new_tree
 
 
@@ -306,24 +494,23 @@ def main():
   parser = argparse.ArgumentParser()
   parser.add_argument("-f", "--filename", action="store", type=str, help="file to parse", default="example.py")
   args = parser.parse_args()
-  with open(args.filename, "r") as source:
-    tree = ast.parse(source.read())
+  tree = ast_cache.cached_parse(args.filename)
 
   sys.stdout.write(f"AST  code:\n")
   astpretty.pprint(tree)
   code_timing = time_tree(tree)
-  branch_transformer = RemoveDeadCode()
+  # remove dead code and collect inlineable functions in one pass
+  branch_transformer = DeadCodeAndInlinePrep()
   pruned_tree = branch_transformer.optimize(tree)
   deadcode_timing = time_tree(pruned_tree)
   sys.stdout.write(f"transformed AST  code:\n")
   astpretty.pprint(pruned_tree)
 
-  function_transformer = InlineFunctions()
+  function_transformer = InlineFunctions(branch_transformer.checker)
 
   inlined_tree = function_transformer.optimize(pruned_tree)
   astpretty.pprint(inlined_tree)
 
-  inlined_tree = ast.fix_missing_locations(inlined_tree)
   inlined_code_timing = time_tree(inlined_tree)
   sys.stdout.write(f"inlined AST  code:\n")
   astpretty.pprint(inlined_tree)
@@ -34,6 +34,15 @@ def test_traversal():
 
   print(baz)
 
+def test_reuse(p):
+  # no messages
+  q = p
+  r = p
+  x = 1
+  print(str(x))
+  print(x)
+  return q + r
+
 
 if __name__ == '__main__':
   # should get message about unused
@@ -44,3 +53,4 @@ if __name__ == '__main__':
   test_function2(20, 30, 40)
   test_nested()
   test_traversal()
+  test_reuse(1)
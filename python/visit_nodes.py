@@ -2,16 +2,18 @@
 
 import argparse
 import ast
+import functools
 import sys
 
+import ast_cache
+
 
 def main():
   parser = argparse.ArgumentParser()
   parser.add_argument("-f", "--filename", action="store", type=str, help="file to parse", default="example.py")
   args = parser.parse_args()
-  with open(args.filename, "r") as source:
-    tree = ast.parse(source.read())
-  sys.stdout.write("Visiting nodes using generic_visit:\n")
+  tree = ast_cache.cached_parse(args.filename)
+  sys.stdout.write("Visiting nodes using specific visit function and generic_visit:\n")
   hello_visitor = HelloVisitor()
   hello_visitor.visit(tree)
   sys.stdout.write("Visiting nodes using specific visit function:\n")
@@ -25,12 +27,13 @@ def main():
 
 class HelloVisitor(ast.NodeVisitor):
   """
-  Print out the names of functions defined in given ast.AST object
+  Print out the names of functions defined in given ast.AST object,
+  including nested functions
   """
-  def generic_visit(self, node: ast.AST):
-    if node.__class__ == ast.FunctionDef:
-      sys.stdout.write(f"Defining function: {node.name} \n")
-    super().generic_visit(node)
+  def visit_FunctionDef(self, node: ast.FunctionDef):
+    sys.stdout.write(f"Defining function: {node.name} \n")
+    # recurse so that nested function definitions are also reported
+    self.generic_visit(node)
 
 
 class FunctionVisitor(ast.NodeVisitor):
@@ -41,112 +44,156 @@ class FunctionVisitor(ast.NodeVisitor):
     sys.stdout.write(f"Defining function: {node.name} \n")
 
 
-class UnusedVariables(ast.NodeVisitor):
+class UnusedVariables:
   """
   Print out variables that are set but might be unused
+
+  Rather than recursing through ast.NodeVisitor, check walks the tree
+  iteratively with an explicit stack and dispatches on node type. Each
+  visit_* handler returns the child nodes that should be walked next.
   """
 
   def __init__(self):
-    super().__init__()
-    self.variable_def = {'global': {'global': [],
-                                    'nonlocal': [],
-                                    'local': []}}
+    self.variable_def = {'global': {'global': {},
+                                    'nonlocal': {},
+                                    'local': {}}}
     self.variable_used = {'global': {}}
     self.stack = ["global"]
+    # (definitions, usages) for each function in stack, innermost last
+    self.scope_chain = [(self.variable_def['global'], self.variable_used['global'])]
     self.function_name = "global"
+    # diagnostics are collected and written out together at the end of check
+    self.messages = []
 
   def check(self, node: ast.AST) -> None:
-    self.generic_visit(node)
-    for var in self.variable_def['global']['local']:
-      if var[0] not in self.variable_used['global']:
-        sys.stdout.write(f"Variable {var[0]} defined in global on line {var[2]} not used\n")
-
-  def visit_FunctionDef(self, node: ast.FunctionDef) -> None:
+    dispatch = {ast.FunctionDef: self.visit_FunctionDef,
+                ast.Assign: self.visit_Assign,
+                ast.Call: self.visit_Call,
+                ast.Name: self.visit_Name,
+                ast.Global: self.visit_Global,
+                ast.Nonlocal: self.visit_Nonlocal}
+    pending = list(reversed(list(ast.iter_child_nodes(node))))
+    while pending:
+      current = pending.pop()
+      if not isinstance(current, ast.AST):
+        # callback to run once all the children of a node have been walked
+        current()
+        continue
+      handler = dispatch.get(type(current))
+      if handler is None:
+        children = ast.iter_child_nodes(current)
+      else:
+        children = handler(current)
+      # push in reverse so that children are walked in source order
+      pending.extend(reversed(list(children)))
+
+    for var, (_, line) in self.variable_def['global']['local'].items():
+      if var not in self.variable_used['global']:
+        self.messages.append(f"Variable {var} defined in global on line {line} not used\n")
+    sys.stdout.writelines(self.messages)
+    self.messages = []
+
+  def visit_FunctionDef(self, node: ast.FunctionDef) -> list:
     self.function_name = node.name
     self.stack.append(node.name)
     self.variable_used[node.name] = {}
-    self.variable_def[node.name] = {'global': [],
-                                    'nonlocal': [],
-                                    'local': []}
+    self.variable_def[node.name] = {'global': {},
+                                    'nonlocal': {},
+                                    'local': {}}
     for arg in node.args.args:
-      self.variable_def[node.name]['local'].append((arg.arg, node.name, node.lineno))
-    super().generic_visit(node)
-    for var in self.variable_def[node.name]['local']:
-      if var[0] not in self.variable_used[node.name]:
-        sys.stdout.write(f"Variable {var[0]} defined in {node.name} on line {var[2]} not used\n")
+      self.variable_def[node.name]['local'][arg.arg] = (node.name, node.lineno)
+    self.scope_chain.append((self.variable_def[node.name], self.variable_used[node.name]))
+    # leave_FunctionDef goes last so that it runs after the function body
+    return [*ast.iter_child_nodes(node), functools.partial(self.leave_FunctionDef, node)]
+
+  def leave_FunctionDef(self, node: ast.FunctionDef) -> None:
+    self.scope_chain.pop()
+    for var, (_, line) in self.variable_def[node.name]['local'].items():
+      if var not in self.variable_used[node.name]:
+        self.messages.append(f"Variable {var} defined in {node.name} on line {line} not used\n")
     del self.variable_used[node.name]
     del self.variable_def[node.name]
     # remove function information
     self.function_name = self.stack.pop()
     self.function_name = self.stack[-1]
 
-  def register_variable(self, scope: str, var_name: str, line: int) -> None:
-    if scope in self.variable_def[self.function_name]:
-      if var_name not in [x[0] for x in self.variable_def[self.function_name][scope]]:
-        self.variable_def[self.function_name][scope].append((var_name, self.function_name, line))
-    else:
-      self.variable_def[self.function_name][scope] = [(var_name, self.function_name, line)]
+  # variable_def maps scope -> {name: (function, line)} so lookups are O(1),
+  # each scope gets its own register method since callers know it statically
+  def register_local(self, var_name: str, line: int) -> None:
+    scope_vars = self.scope_chain[-1][0]['local']
+    if var_name not in scope_vars:
+      scope_vars[var_name] = (self.function_name, line)
+
+  def register_global(self, var_name: str, line: int) -> None:
+    scope_vars = self.scope_chain[-1][0]['global']
+    if var_name not in scope_vars:
+      scope_vars[var_name] = (self.function_name, line)
 
-  def visit_Nonlocal(self, node: ast.Nonlocal) -> None:
+  def register_nonlocal(self, var_name: str, line: int) -> None:
+    scope_vars = self.scope_chain[-1][0]['nonlocal']
+    if var_name not in scope_vars:
+      scope_vars[var_name] = (self.function_name, line)
+
+  def visit_Nonlocal(self, node: ast.Nonlocal) -> list:
     for name in node.names:
-      self.register_variable('nonlocal', name, node.lineno)
+      self.register_nonlocal(name, node.lineno)
+    return []
 
-  def visit_Global(self, node: ast.Global) -> None:
+  def visit_Global(self, node: ast.Global) -> list:
     for name in node.names:
-      self.register_variable('global', name, node.lineno)
+      self.register_global(name, node.lineno)
+    return []
 
-  def visit_Assign(self, node: ast.Assign) -> None:
+  def visit_Assign(self, node: ast.Assign) -> list:
     # register the LHS of assignment
     if isinstance(node.targets[0], ast.Name):
-      self.register_variable('local', node.targets[0].id, node.lineno)
+      self.register_local(node.targets[0].id, node.lineno)
 
     # examine the RHS of assignment
-    super().generic_visit(node.value)
+    return [node.value]
 
-  def visit_Call(self, node: ast.Call) -> None:
-    # visit parameters and register them
+  def visit_Call(self, node: ast.Call) -> list:
+    # visit parameters and register them, walking any that aren't plain
+    # names (e.g. nested calls) so the names inside them are registered too
+    Name = ast.Name
+    children = []
     for arg in node.args:
-      if isinstance(arg, ast.Name):
+      if isinstance(arg, Name):
         self.register_usage(arg.id)
-
-  def var_defined(self, scope: str, var_name: str, function: str = None) -> bool:
-    if function is None:
-      function = self.function_name
-    return var_name in [x[0] for x in self.variable_def[function][scope]]
+      else:
+        children.append(arg)
+    children.extend(keyword.value for keyword in node.keywords)
+    return children
 
   def register_usage(self, var_name: str) -> None:
+    global_used = self.variable_used['global']
 
-    # if we know the var is global we can short-circuit the registration
-    if self.var_defined('global', var_name):
-      if var_name not in self.variable_used['global']:
-        self.variable_used['global'][var_name] = True
-        return
-
-    # otherwise we need to check up the stack
-    for function in reversed(self.stack):
+    # check up the stack, starting with the current function
+    for scope_def, scope_used in reversed(self.scope_chain):
       # short circuit global vars
-      if self.var_defined('global', var_name, function):
-        if var_name not in self.variable_used['global']:
-          self.variable_used['global'][var_name] = True
-          return
+      if var_name in scope_def['global']:
+        if var_name not in global_used:
+          global_used[var_name] = True
+        return
 
       # nonlocal variables are defined deeper in the stack
-      if self.var_defined('nonlocal', var_name, function):
+      if var_name in scope_def['nonlocal']:
         continue
 
       # if definition found, mark var as being used and exit
-      if self.var_defined('local', var_name, function):
-        if var_name not in self.variable_used[function]:
-          self.variable_used[function][var_name] = True
-          return
+      if var_name in scope_def['local']:
+        if var_name not in scope_used:
+          scope_used[var_name] = True
+        return
 
       # continue going deeper in the stack to find the variable
 
     # if we're here, we haven't found the variable anywhere
-    sys.stdout.write(f"In {self.function_name}, {var_name} used without being defined\n")
+    self.messages.append(f"In {self.function_name}, {var_name} used without being defined\n")
 
-  def visit_Name(self, node: ast.Name) -> None:
+  def visit_Name(self, node: ast.Name) -> list:
     self.register_usage(node.id)
+    return []
 
 
 if __name__ == '__main__':